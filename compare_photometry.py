@@ -1,19 +1,35 @@
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Headless rendering, the plot is only saved to file
 import matplotlib.pyplot as plt
 import os
 
+# Offset between Modified Julian Date and Julian Date
+MJD_TO_JD = 2400000.5
+
+# Simplify dense light-curve paths before rasterization
+plt.rcParams.update({
+    'path.simplify': True,
+    'path.simplify_threshold': 1.0,
+    'agg.path.chunksize': 10000
+})
+
 # Read data
 results_file = 'output/photometry_results.csv' if os.path.exists('output/photometry_results.csv') else 'photometry_results.csv'
-results = pd.read_csv(results_file)
-other = pd.read_csv('wasp-46b_datasubset.dat', delimiter='\t')
+results_columns = ['MJD', 'TARGET_MAG', 'TARGET_MAGERR', 'COMP1_MAG', 'COMP2_MAG']
+other_columns = ['#JD_UTC', 'rel_flux_T1', 'rel_flux_C2', 'rel_flux_C3']
+results = pd.read_csv(results_file, usecols=results_columns,
+                      dtype=dict.fromkeys(results_columns, 'float64'))
+other = pd.read_csv('wasp-46b_datasubset.dat', delimiter='\t', usecols=other_columns,
+                    dtype=dict.fromkeys(other_columns, 'float64'))
 
 # Sort both datasets by time
 results = results.sort_values('MJD').reset_index(drop=True)
 other = other.sort_values('#JD_UTC').reset_index(drop=True)
 
 # Convert JD to MJD in the other dataset
-other['MJD'] = other['#JD_UTC'] - 2400000.5
+other['MJD'] = other['#JD_UTC'] - MJD_TO_JD
 
 # Calculate time offset (first integer MJD)
 time_offset = int(min(results['MJD'].min(), other['MJD'].min()))
@@ -28,59 +44,72 @@ print(f"Time difference: {time_diff_first:.3f} seconds")
 # Find pairs of points that are close in time (within 180 seconds / 3 minutes)
 TIME_THRESHOLD = 180.0 / (24 * 3600)  # 180 seconds converted to days
 
-# Create empty lists to store matching pairs
-matching_pairs = []
-
-# For each point in our results, find the closest point in other dataset
-for _, our_row in results.iterrows():
-    time_diff = abs(other['MJD'] - our_row['MJD'])
-    min_diff_idx = time_diff.argmin()
-    min_diff = time_diff[min_diff_idx]
-    
-    # If the closest point is within threshold, save this pair
-    if min_diff <= TIME_THRESHOLD:
-        matching_pairs.append({
-            'MJD_our': our_row['MJD'],
-            'TARGET_MAG': our_row['TARGET_MAG'],
-            'TARGET_MAGERR': our_row['TARGET_MAGERR'],
-            'COMP1_MAG': our_row['COMP1_MAG'],
-            'COMP2_MAG': our_row['COMP2_MAG'],
-            'MJD_other': other['MJD'].iloc[min_diff_idx],
-            'rel_flux_T1': other['rel_flux_T1'].iloc[min_diff_idx],
-            'rel_flux_C2': other['rel_flux_C2'].iloc[min_diff_idx],
-            'rel_flux_C3': other['rel_flux_C3'].iloc[min_diff_idx]
-        })
-
-# Convert list of pairs to DataFrame
-merged = pd.DataFrame(matching_pairs)
+# For each point in our results, find the closest point in other dataset.
+# Both datasets are sorted by MJD, so the nearest neighbour is either the
+# insertion point or the element just before it (ties go to the earlier one).
+o = other['MJD'].to_numpy(dtype=np.float64)
+r = results['MJD'].to_numpy(dtype=np.float64)
+idx = np.searchsorted(o, r)
+right = np.clip(idx, 0, len(o) - 1)
+left = np.clip(idx - 1, 0, len(o) - 1)
+nearest = np.where(np.abs(r - o[left]) <= np.abs(o[right] - r), left, right)
+min_diff = np.abs(o[nearest] - r)
+
+# Keep only pairs where the closest point is within threshold
+mask = min_diff <= TIME_THRESHOLD
+ours = mask.nonzero()[0]
+theirs = nearest[mask]
+
+merged = pd.DataFrame({
+    'MJD_our': r[ours],
+    'TARGET_MAG': results['TARGET_MAG'].to_numpy()[ours],
+    'TARGET_MAGERR': results['TARGET_MAGERR'].to_numpy()[ours],
+    'COMP1_MAG': results['COMP1_MAG'].to_numpy()[ours],
+    'COMP2_MAG': results['COMP2_MAG'].to_numpy()[ours],
+    'MJD_other': o[theirs],
+    'rel_flux_T1': other['rel_flux_T1'].to_numpy()[theirs],
+    'rel_flux_C2': other['rel_flux_C2'].to_numpy()[theirs],
+    'rel_flux_C3': other['rel_flux_C3'].to_numpy()[theirs]
+})
 
 if len(merged) == 0:
     print("\nWARNING: No matching time points found within threshold!")
     print(f"Time threshold: {TIME_THRESHOLD * 24 * 3600:.1f} seconds")
     exit(1)
 
+# Work on plain float64 arrays from here on
+mjd_our = merged['MJD_our'].to_numpy()
+mjd_other = merged['MJD_other'].to_numpy()
+target_mag = merged['TARGET_MAG'].to_numpy()
+target_magerr = merged['TARGET_MAGERR'].to_numpy()
+comp1_mag = merged['COMP1_MAG'].to_numpy()
+comp2_mag = merged['COMP2_MAG'].to_numpy()
+rel_flux_t1 = merged['rel_flux_T1'].to_numpy()
+rel_flux_c2 = merged['rel_flux_C2'].to_numpy()
+rel_flux_c3 = merged['rel_flux_C3'].to_numpy()
+
 # Calculate time differences
-time_diff = abs(merged['MJD_our'] - merged['MJD_other']) * 24 * 3600  # Convert to seconds
+time_diff = np.abs(mjd_our - mjd_other) * 24 * 3600  # Convert to seconds
 print(f"\nFound {len(merged)} matching time points")
 print(f"Time differences statistics (seconds):")
 print(f"  Mean: {time_diff.mean():.3f}")
 print(f"  Max:  {time_diff.max():.3f}")
 print(f"  Min:  {time_diff.min():.3f}")
-print(f"  Std:  {time_diff.std():.3f}")
+print(f"  Std:  {time_diff.std(ddof=1):.3f}")
 
 # Calculate magnitude differences for BHT dataset
-bht_target_comp1 = merged['TARGET_MAG'] - merged['COMP1_MAG']
-bht_target_comp2 = merged['TARGET_MAG'] - merged['COMP2_MAG']
-bht_comp1_comp2 = merged['COMP1_MAG'] - merged['COMP2_MAG']
+bht_target_comp1 = target_mag - comp1_mag
+bht_target_comp2 = target_mag - comp2_mag
+bht_comp1_comp2 = comp1_mag - comp2_mag
 
 # Calculate magnitude differences for AIJ dataset
-aij_target_comp1 = -2.5 * np.log10(merged['rel_flux_T1'] / merged['rel_flux_C2'])
-aij_target_comp2 = -2.5 * np.log10(merged['rel_flux_T1'] / merged['rel_flux_C3'])
-aij_comp1_comp2 = -2.5 * np.log10(merged['rel_flux_C2'] / merged['rel_flux_C3'])
+aij_target_comp1 = -2.5 * np.log10(rel_flux_t1 / rel_flux_c2)
+aij_target_comp2 = -2.5 * np.log10(rel_flux_t1 / rel_flux_c3)
+aij_comp1_comp2 = -2.5 * np.log10(rel_flux_c2 / rel_flux_c3)
 
 # Convert time to hours from first observation
-time_hours_bht = (merged['MJD_our'] - time_offset) * 24
-time_hours_aij = (merged['MJD_other'] - time_offset) * 24
+time_hours_bht = (mjd_our - time_offset) * 24
+time_hours_aij = (mjd_other - time_offset) * 24
 
 # Create figure with 5 subplots (2 for light curves, 3 for residuals)
 fig, axs = plt.subplots(5, 1, figsize=(14, 16), height_ratios=[1.5, 1.5, 1, 1, 1])
@@ -91,7 +120,7 @@ plt.subplots_adjust(hspace=0.3)
 # Plot 1: BHT light curves
 ax_bht = axs[0]
 ax_bht.errorbar(time_hours_bht, bht_target_comp1, 
-               yerr=merged['TARGET_MAGERR'],
+               yerr=target_magerr,
                fmt='o', markersize=4, label='Target-Comp1', color='blue', capsize=2, alpha=0.7)
 ax_bht.plot(time_hours_bht, bht_target_comp2,
           'o', markersize=4, label='Target-Comp2', color='red', alpha=0.7)
@@ -230,5 +259,5 @@ print(f"Comp1-Comp2: mean = {np.mean(res_comp1_comp2):.3f} ± {np.std(res_comp1_
 # Create plots directory if needed
 os.makedirs('plots', exist_ok=True)
 output_plot = 'plots/photometry_comparison.png'
-plt.savefig(output_plot)
+plt.savefig(output_plot, dpi=100)
 print(f"\nPlot saved to {output_plot}")
@@ -5,9 +5,13 @@ Convert photometry_results.csv to differential magnitude format.
 Output: JD_UTC, diff_mag (TARGET - COMP1), error_diff_mag
 """
 
+import io
 import pandas as pd
 import numpy as np
 
+# Offset between Modified Julian Date and Julian Date
+_MJD_TO_JD = 2400000.5
+
 def convert_to_differential_magnitude(input_file=None, 
                                        output_file='output/photometry_results_diffmag.dat'):
     """
@@ -28,13 +32,15 @@ def convert_to_differential_magnitude(input_file=None,
     os.makedirs('output', exist_ok=True)
     
     print(f"Reading photometry data from {input_file}...")
-    df = pd.read_csv(input_file)
+    columns = ['MJD', 'TARGET_MAG', 'TARGET_MAGERR', 'COMP1_MAG', 'COMP2_MAG']
+    df = pd.read_csv(input_file, usecols=columns,
+                     dtype=dict.fromkeys(columns, 'float64'))
     
     print(f"Found {len(df)} measurements")
     print(f"Columns: {df.columns.tolist()}")
     
     # Convert MJD to JD_UTC
-    df['JD_UTC'] = df['MJD'] + 2400000.5
+    jd = df['MJD'].to_numpy() + _MJD_TO_JD
     
     # Calculate differential magnitude: TARGET - COMP1
     diff_mag = df['TARGET_MAG'] - df['COMP1_MAG']
@@ -51,24 +57,27 @@ def convert_to_differential_magnitude(input_file=None,
     print(f"Target - Comp1: mean = {diff_mag.mean():.4f}, std = {diff_mag.std():.4f}")
     print(f"Target - Comp2: mean = {diff_mag_comp2.mean():.4f}, std = {diff_mag_comp2.std():.4f}")
     
-    # Save as space-separated file with # in header
-    with open(output_file, 'w') as f:
-        # Write header with # prefix
-        f.write('#JD_UTC\tdiff_mag\terror_diff_mag\n')
-        # Write data rows
-        for i in range(len(df)):
-            jd = df['JD_UTC'].iloc[i]
-            dmag = diff_mag.iloc[i]
-            err = error_diff_mag.iloc[i]
-            f.write(f"{jd:.10f}\t{dmag:.6f}\t{err:.6f}\n")
+    output_df = pd.DataFrame({
+        'JD_UTC': jd,
+        'diff_mag': diff_mag.to_numpy(),
+        'error_diff_mag': error_diff_mag.to_numpy()
+    })
+    
+    # Save as space-separated file with # in header.
+    # Format everything in memory first so the file gets a single write.
+    buf = io.StringIO()
+    np.savetxt(buf, output_df.to_numpy(),
+               fmt=['%.10f', '%.6f', '%.6f'], delimiter='\t',
+               header='JD_UTC\tdiff_mag\terror_diff_mag', comments='#')
+    with open(output_file, 'w', buffering=1 << 20) as f:
+        f.write(buf.getvalue())
     
     print(f"\nDifferential magnitude file saved to {output_file}")
     print(f"Format: space/tab separated with # header")
     
     # Display first few rows
     print("\nFirst 5 measurements:")
-    for i in range(min(5, len(df))):
-        print(f"JD={df['JD_UTC'].iloc[i]:.6f}  diff_mag={diff_mag.iloc[i]:.6f}  error={error_diff_mag.iloc[i]:.6f}")
+    print(output_df.head(5).to_string(index=False, float_format=lambda v: f'{v:.6f}'))
     
     # Statistics
     print(f"\nStatistics:")
@@ -5,9 +5,15 @@ Convert photometry_results.csv from magnitude format to flux format.
 Output: JD_UTC, flux_source, error_flux_source
 """
 
+import math
 import pandas as pd
 import numpy as np
 
+# ln(10)/2.5: converts magnitudes to natural-log flux units
+_LN10_OVER_2P5 = math.log(10.0) / 2.5
+# Offset between Modified Julian Date and Julian Date
+_MJD_TO_JD = 2400000.5
+
 def mag_to_flux(mag, mag_err=None, reference_flux=1.0):
     """
     Convert magnitude to flux.
@@ -21,13 +27,13 @@ def mag_to_flux(mag, mag_err=None, reference_flux=1.0):
         flux: Flux value
         flux_err: Flux error (if mag_err provided)
     """
-    # Flux = reference_flux * 10^(-mag/2.5)
-    flux = reference_flux * 10**(-mag / 2.5)
+    # Flux = reference_flux * 10^(-mag/2.5) = reference_flux * exp(-mag * ln(10)/2.5)
+    flux = reference_flux * np.exp(mag * -_LN10_OVER_2P5)
     
     if mag_err is not None:
         # Error propagation: dF/F = (ln(10)/2.5) * dmag
         # flux_err = flux * (ln(10)/2.5) * mag_err
-        flux_err = flux * (np.log(10) / 2.5) * mag_err
+        flux_err = flux * (_LN10_OVER_2P5 * mag_err)
         return flux, flux_err
     
     return flux
@@ -50,13 +56,16 @@ def convert_photometry_to_flux(input_file=None,
     os.makedirs('output', exist_ok=True)
     
     print(f"Reading photometry data from {input_file}...")
-    df = pd.read_csv(input_file)
+    columns = ['MJD', 'TARGET_RA', 'TARGET_DEC', 'TARGET_SEP',
+               'TARGET_MAG', 'TARGET_MAGERR', 'COMP1_MAG', 'COMP2_MAG']
+    df = pd.read_csv(input_file, usecols=columns,
+                     dtype=dict.fromkeys(columns, 'float64'))
     
     print(f"Found {len(df)} measurements")
     print(f"Columns: {df.columns.tolist()}")
     
     # Convert MJD to JD_UTC
-    df['JD_UTC'] = df['MJD'] + 2400000.5
+    jd = df['MJD'].to_numpy() + _MJD_TO_JD
     
     # Convert target magnitude to flux
     print("\nConverting magnitudes to fluxes...")
@@ -69,7 +78,7 @@ def convert_photometry_to_flux(input_file=None,
     
     # Create output dataframe
     output_df = pd.DataFrame({
-        'JD_UTC': df['JD_UTC'],
+        'JD_UTC': jd,
         'flux_source': target_flux,
         'error_flux_source': target_flux_err,
         'flux_comp1': comp1_flux,
@@ -98,12 +107,9 @@ def convert_photometry_to_flux(input_file=None,
     simple_output = output_file.replace('.csv', '_simple.dat')
     
     # Save as space-separated file with # in header
-    with open(simple_output, 'w') as f:
-        # Write header with # prefix
-        f.write('#JD_UTC\tflux_source\terror_flux_source\n')
-        # Write data rows
-        for _, row in simple_df.iterrows():
-            f.write(f"{row['JD_UTC']:.10f}\t{row['flux_source']:.10e}\t{row['error_flux_source']:.10e}\n")
+    np.savetxt(simple_output, simple_df.to_numpy(),
+               fmt=['%.10f', '%.10e', '%.10e'], delimiter='\t',
+               header='JD_UTC\tflux_source\terror_flux_source', comments='#')
     
     print(f"\nSimplified flux file (JD_UTC, flux_source, error_flux_source only) saved to {simple_output}")
     print(f"Format: space/tab separated with # header")
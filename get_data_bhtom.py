@@ -6,16 +6,20 @@ Script for downloading and processing photometric data from BHTOM.
 
 import json
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Optional, List, Dict, Tuple
 import pandas as pd
 import io
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from astropy import units as u
-from astropy.coordinates import Angle, SkyCoord
+from astropy.coordinates import Angle
 from astropy.time import Time
 import numpy as np
+from scipy.spatial import cKDTree
 import os
+import sys
 
 # Load API credentials and configuration from environment variables or config file
 def load_api_config():
@@ -62,47 +66,87 @@ except ValueError as e:
     API_BASE_URL = None
     HEADERS = None
 
-def get_data_products(target_name: str, mjd_min: float, mjd_max: float) -> pd.DataFrame:
+# API endpoints
+DATA_URL = f"{API_BASE_URL}data/" if API_BASE_URL else None
+DOWNLOAD_URL = f"{API_BASE_URL}downloadPhotometryFile/" if API_BASE_URL else None
+
+# Columns and fixed dtypes of the photometry files served by BHTOM
+PHOTOMETRY_DTYPES = {
+    'NUMBER': np.int64,
+    'ALPHA_J2000': np.float64,
+    'DELTA_J2000': np.float64,
+    'XWIN_IMAGE': np.float64,
+    'YWIN_IMAGE': np.float64,
+    'MAG_AUTO': np.float64,
+    'MAGERR_AUTO': np.float64
+}
+
+# Shared HTTP session so all API calls reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                      max_retries=Retry(total=3, backoff_factor=0.5)))
+if HEADERS:
+    SESSION.headers.update(HEADERS)
+
+def _fetch_data_page(target_name: str, mjd_min: float, mjd_max: float, page: int) -> Optional[dict]:
+    """Fetch a single page of the data product list.
+    
+    Returns:
+        Decoded JSON response, or None if the request failed
+    """
+    request_body = {
+        "target_name": target_name,
+        "mjd_min": mjd_min,
+        "mjd_max": mjd_max,
+        "page": page
+    }
+    
+    response = SESSION.post(DATA_URL, json=request_body)
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+def get_data_products(target_name: str, mjd_min: float, mjd_max: float,
+                      max_workers: int = 8) -> pd.DataFrame:
     """Fetch all data products for a given target and time range.
     
+    The first page is fetched on its own to learn the number of pages,
+    the remaining pages are then requested concurrently.
+    
     Args:
         target_name: Name of the target
         mjd_min: Minimum Modified Julian Date
         mjd_max: Maximum Modified Julian Date
+        max_workers: Number of pages requested concurrently
         
     Returns:
         DataFrame containing all data products
     """
+    first_page = _fetch_data_page(target_name, mjd_min, mjd_max, 1)
+    if first_page is None:
+        return pd.DataFrame()
+    num_pages = first_page.get("num_pages", 1)
+    
+    pages = [first_page]
+    if num_pages > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages += executor.map(
+                lambda page: _fetch_data_page(target_name, mjd_min, mjd_max, page),
+                range(2, num_pages + 1)
+            )
+    
+    # Stop at the first failed or empty page, as the sequential listing did
     dfs = []
-    page = 1
-
-    while True:
-        request_body = {
-            "target_name": target_name,
-            "mjd_min": mjd_min,
-            "mjd_max": mjd_max,
-            "page": page
-        }
-
-        response = requests.post(f"{API_BASE_URL}data/", json=request_body, headers=HEADERS)
-        if response.status_code != 200:
-            break
-
-        data_json = response.json()
-        data_list = data_json.get("data", [])
-        
+    for page, data_json in enumerate(pages, start=1):
+        data_list = data_json.get("data", []) if data_json else []
         if not data_list:
             break
-
+        
         df_page = pd.DataFrame(data_list)
         dfs.append(df_page)
         
         print(f"Processed page {page} with {len(df_page)} records")
-        
-        page += 1
-        if page > data_json.get("num_pages", 1):
-            break
-
+    
     return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
 
 def download_photometry_file(data_id: int) -> pd.DataFrame:
@@ -115,35 +159,36 @@ def download_photometry_file(data_id: int) -> pd.DataFrame:
         DataFrame containing the photometry data
     """
     request_body = {"id": data_id}
-    response = requests.post(
-        f"{API_BASE_URL}downloadPhotometryFile/",
-        json=request_body,
-        headers=HEADERS
-    )
+    response = SESSION.post(DOWNLOAD_URL, json=request_body)
     
     if response.status_code != 200:
         print(f"Failed to download data for ID {data_id}")
         return pd.DataFrame()
 
-    data_io = io.StringIO(response.text)
+    # Parse the raw bytes directly (no text decode) with the C tokenizer;
+    # sep=r'\s+' is handled natively by the C engine, no regex involved
+    data_io = io.BytesIO(response.content)
     return pd.read_csv(
         data_io,
         comment='#',
-        sep='\s+',  # Use regex pattern for any whitespace
+        sep=r'\s+',
+        engine='c',
         header=None,
-        names=[
-            'NUMBER', 'ALPHA_J2000', 'DELTA_J2000', 'XWIN_IMAGE',
-            'YWIN_IMAGE', 'MAG_AUTO', 'MAGERR_AUTO'
-        ]
+        names=list(PHOTOMETRY_DTYPES),
+        dtype=PHOTOMETRY_DTYPES,
+        low_memory=False,  # Parse each file in one chunk
+        float_precision='high'
     )
 
-def process_all_data(target_name: str, mjd_min: float, mjd_max: float) -> Dict[str, Dict]:
+def process_all_data(target_name: str, mjd_min: float, mjd_max: float,
+                     max_workers: int = 8) -> Dict[str, Dict]:
     """Process all photometry data for a given target and time range.
     
     Args:
         target_name: Name of the target
         mjd_min: Minimum Modified Julian Date
         mjd_max: Maximum Modified Julian Date
+        max_workers: Number of photometry files downloaded concurrently
         
     Returns:
         Dictionary mapping data IDs to their corresponding data dictionary containing:
@@ -156,12 +201,16 @@ def process_all_data(target_name: str, mjd_min: float, mjd_max: float) -> Dict[s
     if data_products.empty:
         print("No data products found")
         return {}
-
+    
     # Get all unique IDs and their calibration data
-    results = {}
-    for _, row in data_products.iterrows():
-        data_id = row['id']
-        calibration_data = row.get('calibration_data', {})
+    data_ids = data_products['id'].tolist()
+    if 'calibration_data' in data_products:
+        calibrations = data_products['calibration_data'].tolist()
+    else:
+        calibrations = [{}] * len(data_ids)
+    
+    tasks = []
+    for data_id, calibration_data in zip(data_ids, calibrations):
         mjd = calibration_data.get('mjd') if calibration_data else None
         
         if mjd is None:
@@ -169,20 +218,32 @@ def process_all_data(target_name: str, mjd_min: float, mjd_max: float) -> Dict[s
             continue
             
         print(f"Processing data ID: {data_id} (MJD: {mjd})")
-        df = download_photometry_file(data_id)
-        
-        if not df.empty:
-            results[data_id] = {
-                'df': df,
-                'mjd': mjd,
-                'calibration_data': calibration_data
-            }
-
+        tasks.append((data_id, mjd, calibration_data))
+    
+    # Download files concurrently; map() keeps results in data product order
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = executor.map(download_photometry_file, [task[0] for task in tasks])
+        for (data_id, mjd, calibration_data), df in zip(tasks, dfs):
+            if not df.empty:
+                results[data_id] = {
+                    'df': df,
+                    'mjd': mjd,
+                    'calibration_data': calibration_data
+                }
+    
     print(f"Found {len(results)} data products with valid MJD")
     return results
 
+def _radec_to_unit_vectors(ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+    """Convert RA/Dec in degrees to an (N, 3) array of unit vectors on the sphere."""
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
 def cross_match_observations(results: Dict[str, Dict], max_separation: float = 1.0) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    """Cross-match observations from all files using astropy's coordinate matching.
+    """Cross-match observations from all files using a KD-tree on the unit sphere.
     
     Args:
         results: Dictionary with photometry results from process_all_data
@@ -194,10 +255,15 @@ def cross_match_observations(results: Dict[str, Dict], max_separation: float = 1
         - reference_objects: DataFrame with reference object IDs and their coordinates
     """
     # Sort results by MJD to find the reference epoch
-    sorted_results = dict(sorted(results.items(), key=lambda x: x[1]['mjd']))
+    data_ids = list(results)
+    mjds = np.fromiter((results[data_id]['mjd'] for data_id in data_ids),
+                       dtype=np.float64, count=len(data_ids))
+    order = np.argsort(mjds, kind='stable')
+    mjds = mjds[order]
     
     # Get the reference epoch data (earliest MJD)
-    ref_id, ref_data = next(iter(sorted_results.items()))
+    ref_id = data_ids[order[0]]
+    ref_data = results[ref_id]
     ref_df = ref_data['df']
     ref_mjd = ref_data['mjd']
     
@@ -206,60 +272,100 @@ def cross_match_observations(results: Dict[str, Dict], max_separation: float = 1
     # Create reference catalog
     reference_objects = pd.DataFrame({
         'REF_ID': range(len(ref_df)),
-        'ORIG_NUMBER': ref_df['NUMBER'].values,  # Convert to numpy array
-        'RA': ref_df['ALPHA_J2000'].values,      # Convert to numpy array
-        'DEC': ref_df['DELTA_J2000'].values      # Convert to numpy array
+        'ORIG_NUMBER': ref_df['NUMBER'].to_numpy(copy=False),
+        'RA': ref_df['ALPHA_J2000'].to_numpy(copy=False),
+        'DEC': ref_df['DELTA_J2000'].to_numpy(copy=False)
     })
     
-    # Create reference SkyCoord object
-    ref_coords = SkyCoord(ra=reference_objects['RA'], dec=reference_objects['DEC'], 
-                         unit='deg', frame='icrs')
+    # Build KD-tree on reference unit vectors; chord length grows monotonically
+    # with angular separation, so nearest in 3D is nearest on the sky
+    ref_tree = cKDTree(_radec_to_unit_vectors(reference_objects['RA'].to_numpy(),
+                                              reference_objects['DEC'].to_numpy()))
+    max_chord = 2 * np.sin(np.deg2rad(max_separation / 3600) / 2)
     
-    # Initialize measurements DataFrame
-    measurements = []
+    n_ref = len(reference_objects)
+    n_epochs = len(order)
     
-    # Process each epoch
-    for data_id, data in sorted_results.items():
-        df = data['df']
-        mjd = data['mjd']
-        
-        # Create SkyCoord for current epoch
-        current_coords = SkyCoord(ra=df['ALPHA_J2000'].values, 
-                                dec=df['DELTA_J2000'].values,
-                                unit='deg', frame='icrs')
-        
-        # Find matches
-        idx, d2d, _ = current_coords.match_to_catalog_sky(ref_coords)
-        matches = d2d < max_separation*u.arcsec
-        
-        # Create row for this epoch
-        row = {'MJD': mjd}
-        
-        # Add magnitude and error for each reference object
-        for ref_idx in range(len(reference_objects)):
-            # Find if there's a match for this reference object
-            match_idx = np.where((idx == ref_idx) & matches)[0]
-            
-            if len(match_idx) > 0:
-                # Use the first match if multiple matches exist
-                match_data = df.iloc[match_idx[0]]
-                row[f'MAG_{ref_idx}'] = match_data['MAG_AUTO']
-                row[f'MAGERR_{ref_idx}'] = match_data['MAGERR_AUTO']
-            else:
-                row[f'MAG_{ref_idx}'] = None
-                row[f'MAGERR_{ref_idx}'] = None
-        
-        measurements.append(row)
+    # Stack all epochs into one detection list, remembering each row's epoch
+    dfs = [results[data_ids[i]]['df'] for i in order]
+    epoch_ids = np.repeat(np.arange(n_epochs), [len(df) for df in dfs])
+    match_columns = ['ALPHA_J2000', 'DELTA_J2000', 'MAG_AUTO', 'MAGERR_AUTO']
+    stacked = np.concatenate([df[match_columns].to_numpy(dtype=np.float64) for df in dfs])
+    all_ra, all_dec, all_mag, all_magerr = stacked.T
     
-    # Create measurements DataFrame
-    measurements_df = pd.DataFrame(measurements)
+    # Match every detection of every epoch against the reference catalog in one call
+    chord, idx = ref_tree.query(_radec_to_unit_vectors(all_ra, all_dec), k=1, workers=-1)
+    sel = np.flatnonzero(chord < max_chord)
     
-    print(f"\nMatched {len(reference_objects)} reference objects across {len(measurements)} epochs")
+    # Scatter matched magnitudes onto (epoch, reference object) cells, using the
+    # first match if multiple detections in an epoch match the same reference object
+    cells, first = np.unique(epoch_ids[sel] * n_ref + idx[sel], return_index=True)
+    mag_matrix = np.full((n_epochs, n_ref), np.nan)
+    magerr_matrix = np.full((n_epochs, n_ref), np.nan)
+    mag_matrix.flat[cells] = all_mag[sel[first]]
+    magerr_matrix.flat[cells] = all_magerr[sel[first]]
+    
+    # Create measurements DataFrame with columns MJD, MAG_0, MAGERR_0, MAG_1, ...
+    values = np.empty((n_epochs, 1 + 2 * n_ref))
+    values[:, 0] = mjds
+    values[:, 1::2] = mag_matrix
+    values[:, 2::2] = magerr_matrix
+    columns = ['MJD']
+    for ref_idx in range(n_ref):
+        columns += [f'MAG_{ref_idx}', f'MAGERR_{ref_idx}']
+    measurements_df = pd.DataFrame(values, columns=columns)
+    
+    print(f"\nMatched {n_ref} reference objects across {n_epochs} epochs")
     
     return measurements_df, reference_objects
 
-def main():
-    """Main function to download and save photometry data."""
+def _json_default(obj):
+    """Convert NumPy scalars (e.g. data IDs taken from pandas) for json.dump."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def save_photometry_data(results: Dict[str, Dict], output_file: str) -> str:
+    """Save photometry results as a long-format Parquet table plus JSON metadata.
+    
+    Every detection becomes one row of the Parquet table, tagged with its
+    data_id and mjd. Calibration data for each epoch goes to a JSON sidecar
+    next to the table (same name, .json extension), in epoch order.
+    
+    Args:
+        results: Dictionary with photometry results from process_all_data
+        output_file: Path of the Parquet file to write
+        
+    Returns:
+        Path of the JSON metadata file
+    """
+    frames = [data['df'].assign(data_id=data_id, mjd=data['mjd'])
+              for data_id, data in results.items()]
+    if frames:
+        table = pd.concat(frames, ignore_index=True)
+    else:
+        table = pd.DataFrame(columns=list(PHOTOMETRY_DTYPES) + ['data_id', 'mjd'])
+    table.to_parquet(output_file, engine='pyarrow', compression='snappy', index=False)
+    
+    metadata = [
+        {'data_id': data_id, 'mjd': data['mjd'], 'calibration_data': data['calibration_data']}
+        for data_id, data in results.items()
+    ]
+    metadata_file = os.path.splitext(output_file)[0] + '.json'
+    with open(metadata_file, 'w') as f:
+        json.dump(metadata, f, default=_json_default)
+    
+    return metadata_file
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Main function to download and save photometry data.
+    
+    Args:
+        argv: Command line arguments (defaults to sys.argv[1:])
+        
+    Returns:
+        Exit code: 0 on success, 1 if no data products were downloaded
+    """
     import argparse
     
     parser = argparse.ArgumentParser(description='Download photometry data from BHTOM')
@@ -269,7 +375,7 @@ def main():
     group.add_argument('--mjd-range', type=float, nargs=2, metavar=('MJD_MIN', 'MJD_MAX'),
                       help='MJD range (min max)')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # Ustawiamy zakres czasowy
     if args.mjd_range:
@@ -290,13 +396,13 @@ def main():
     print(f"\nProcessed {len(results)} data products successfully")
     
     # Save raw photometry data
-    import pickle
-    import os
     os.makedirs('data', exist_ok=True)
-    output_file = 'data/photometry_data.pkl'
-    with open(output_file, 'wb') as f:
-        pickle.dump(results, f)
-    print(f"\nRaw photometry data saved to '{output_file}'")
+    output_file = 'data/photometry_data.parquet'
+    metadata_file = save_photometry_data(results, output_file)
+    print(f"\nRaw photometry data saved to '{output_file}' (metadata: '{metadata_file}')")
+    
+    if not results:
+        return 1
     
     print("\nExample data from first epoch:")
     first_id = next(iter(results))
@@ -305,6 +411,7 @@ def main():
     print(f"MJD: {first_data['mjd']:.6f}")
     print("\nFirst 3 objects:")
     print(first_data['df'].head(3).to_string())
+    return 0
     
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -1,6 +1,7 @@
 import requests
 from io import BytesIO
 import numpy as np
+import pandas as pd
 from astropy.io import fits
 from astropy.wcs import WCS
 import matplotlib.pyplot as plt
@@ -11,15 +12,11 @@ import numpy as np
 def read_objects_data(filename='objects.dat'):
     """Read object coordinates from file."""
     print(f"Reading coordinates from {filename}")
-    objects = {}
-    with open(filename, 'r') as f:
-        for line in f:
-            obj_type, ra, dec = line.strip().split(',')
-            objects[obj_type] = {
-                'ra': float(ra),
-                'dec': float(dec)
-            }
-            print(f"Found {obj_type}: RA={ra}°, Dec={dec}°")
+    df = pd.read_csv(filename, header=None, names=['type', 'ra', 'dec'],
+                     dtype={'ra': np.float64, 'dec': np.float64})
+    objects = df.set_index('type').to_dict('index')
+    for obj_type, coords in objects.items():
+        print(f"Found {obj_type}: RA={coords['ra']}°, Dec={coords['dec']}°")
     return objects
 
 def plot_dss_field():
@@ -65,9 +62,10 @@ def plot_dss_field():
     print("\nProcessing image...")
     img = image[0].data
     # Normalize image data for better display
-    img = np.clip(img, np.percentile(img, 1), np.percentile(img, 99))
+    lo, hi = np.percentile(img, [1, 99])  # Both cuts from a single partition pass
+    img = np.clip(img, lo, hi)
     print(f"Image shape: {img.shape}")
-    plt.imshow(img, cmap='gray_r', origin='lower')
+    plt.imshow(img, cmap='gray_r', origin='lower', rasterized=True, interpolation='nearest')
     plt.gca().set_axis_off()
     
     # Get image WCS
@@ -109,8 +107,8 @@ def plot_dss_field():
     import os
     os.makedirs('plots', exist_ok=True)
     output_file = 'plots/dss_field.png'
-    plt.savefig(output_file, dpi=150)
-    print(f"Plot saved as {output_file} with DPI=150")
+    plt.savefig(output_file, dpi=100, pil_kwargs={'optimize': True})
+    print(f"Plot saved as {output_file} with DPI=100")
     print("\n=== DSS field plot generation completed ===")
 
 if __name__ == '__main__':
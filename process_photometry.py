@@ -1,10 +1,18 @@
 import pandas as pd
 import numpy as np
-from astropy.coordinates import SkyCoord
-import astropy.units as u
 from astropy.time import Time
+import matplotlib
+matplotlib.use('Agg')  # Headless rendering, plots are only saved to file
 import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
 import argparse
+import json
+import logging
+import os
+import pickle
+import sys
+
+logger = logging.getLogger(__name__)
 
 def read_objects_data(filename: str) -> dict:
     """Read object definitions from objects.dat."""
@@ -14,11 +22,9 @@ def read_objects_data(filename: str) -> dict:
     df = pd.read_csv(filename, header=None, names=['Type', 'RA', 'DEC'])
     
     # Handle target and comparison stars
-    for _, row in df.iterrows():
-        name = row['Type'].lower()
-        ra = float(row['RA'])  # RA in degrees
-        dec = float(row['DEC'])  # Dec in degrees
-        
+    for name, ra, dec in zip(df['Type'].str.lower().tolist(),
+                             df['RA'].to_numpy(float).tolist(),  # RA in degrees
+                             df['DEC'].to_numpy(float).tolist()):  # Dec in degrees
         if name == 'target':
             objects['target'] = f"{name},{ra},{dec}"
         else:  # Comparison stars
@@ -33,115 +39,207 @@ def read_objects_data(filename: str) -> dict:
     
     return objects
 
-def find_nearest_object(df: pd.DataFrame, ra: float, dec: float, max_distance: float = 5.0) -> tuple:
-    """Find the nearest object in DataFrame to given coordinates within max_distance arcseconds."""
-    # Filter out invalid coordinates
-    valid_coords = df[
-        (df['DELTA_J2000'] >= -90) & 
-        (df['DELTA_J2000'] <= 90) & 
-        (df['ALPHA_J2000'] >= 0) & 
-        (df['ALPHA_J2000'] < 360)
-    ].copy()
-    
-    if len(valid_coords) == 0:
-        print("Warning: No valid coordinates found in the data")
-        return None, None
-    
-    coords = SkyCoord(ra=valid_coords['ALPHA_J2000'].values*u.degree, 
-                     dec=valid_coords['DELTA_J2000'].values*u.degree)
-    target = SkyCoord(ra=ra*u.degree, dec=dec*u.degree)
-    
-    # Calculate separations to all objects
-    seps = target.separation(coords)
-    
-    # Find the closest object within max_distance
-    min_idx = np.argmin(seps)
-    min_sep = seps[min_idx]
-    
-    if min_sep.arcsec > max_distance:
-        return None, None
-    
-    # Convert index back to original DataFrame index
-    original_idx = valid_coords.index[min_idx]
-    return original_idx, min_sep.arcsec
+def _radec_to_unit_vectors(ra, dec) -> np.ndarray:
+    """Convert RA/Dec in degrees to an (N, 3) array of unit vectors on the sphere."""
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
 
-def find_nearest_mjd_position(positions_df: pd.DataFrame, mjd: float) -> tuple:
-    """Find asteroid position at the nearest MJD."""
-    # Find the nearest time
-    idx = np.abs(positions_df['MJD'] - mjd).argmin()
-    return positions_df.iloc[idx][['RA', 'DEC']]
+def _chord_to_arcsec(chord):
+    """Convert chord length between unit vectors to angular separation in arcseconds."""
+    return np.rad2deg(2 * np.arcsin(np.minimum(chord, 2.0) / 2)) * 3600
 
-def process_asteroid_photometry(photometry_data: dict, positions_df: pd.DataFrame, objects: dict) -> pd.DataFrame:
-    """Process photometry data using comparison stars."""
-    results = []
+# Columns gathered for each matched object
+_GATHER_COLUMNS = ['MAG_AUTO', 'MAGERR_AUTO', 'ALPHA_J2000', 'DELTA_J2000']
+
+# Offset between epochs along the extra KD-tree axis; larger than the longest
+# possible chord between unit vectors (2), so a query never crosses epochs
+_EPOCH_SPACING = 4.0
+
+def _prepare_catalog(dfs: list) -> tuple:
+    """Build one KD-tree over the valid coordinates of all epochs for nearest-object queries.
     
-    # Sort positions by MJD
-    positions_df = positions_df.sort_values('MJD')
-    mjd_min = positions_df['MJD'].min()
-    mjd_max = positions_df['MJD'].max()
+    Each epoch's unit vectors get a fourth coordinate epoch * _EPOCH_SPACING,
+    so a query tagged with an epoch only ever finds objects from that epoch.
     
-    for data_id, data in photometry_data.items():
-        mjd = data['mjd']
-        df = data['df']
-        
-        # Skip if MJD is outside our asteroid position range
-        if mjd < mjd_min or mjd > mjd_max:
-            print(f"Warning: MJD {mjd} is outside asteroid position range ({mjd_min:.6f} to {mjd_max:.6f})")
-            continue
-        
-        # Find comparison stars
-        print(f"\nLooking for stars in data_id {data_id}:")
-        print(f"Comp1 target: RA={objects['comp1']['ra']:.6f}°, Dec={objects['comp1']['dec']:.6f}°")
-        print(f"Comp2 target: RA={objects['comp2']['ra']:.6f}°, Dec={objects['comp2']['dec']:.6f}°")
-        print("First 3 objects in the data:")
-        print(df[['ALPHA_J2000', 'DELTA_J2000', 'MAG_AUTO']].head(3))
-        
-        comp1_idx, comp1_sep = find_nearest_object(df, objects['comp1']['ra'], objects['comp1']['dec'])
-        comp2_idx, comp2_sep = find_nearest_object(df, objects['comp2']['ra'], objects['comp2']['dec'])
-        
-        if comp1_idx is not None:
-            print(f"Found Comp1 at separation {comp1_sep:.1f} arcsec")
-        if comp2_idx is not None:
-            print(f"Found Comp2 at separation {comp2_sep:.1f} arcsec")
-        
-        if comp1_idx is None or comp2_idx is None:
-            print(f"Warning: Could not find comparison stars in data_id {data_id}")
-            continue
+    Args:
+        dfs: List of per-epoch DataFrames
         
-        # Find nearest asteroid position
-        ast_pos = find_nearest_mjd_position(positions_df, mjd)
-        ast_ra, ast_dec = ast_pos['RA'], ast_pos['DEC']
+    Returns:
+        Tuple (row_epoch, row_idx, tree), or None if no coordinates are valid.
+        row_idx are row positions in the epochs stacked in order (see _stack_columns)
+    """
+    row_epoch, row_idx, xyz = [], [], []
+    offset = 0
+    for epoch, df in enumerate(dfs):
+        ra = df['ALPHA_J2000'].to_numpy()
+        dec = df['DELTA_J2000'].to_numpy()
+        valid = (dec >= -90) & (dec <= 90) & (ra >= 0) & (ra < 360)
+        offset += len(df)
         
-        # Find asteroid with larger search radius (JPL positions can be off by ~15")
-        ast_idx, ast_sep = find_nearest_object(df, ast_ra, ast_dec, max_distance=20.0)
-        if ast_idx is None:
-            print(f"Warning: Could not find asteroid at RA={ast_ra:.6f}°, Dec={ast_dec:.6f}° in data_id {data_id}")
+        if not valid.any():
+            logger.debug("Warning: No valid coordinates found in the data")
             continue
         
-        # Extract magnitudes and check for valid values
-        ast_mag = df.iloc[ast_idx]['MAG_AUTO']
-        ast_magerr = df.iloc[ast_idx]['MAGERR_AUTO']
-        comp1_mag = df.iloc[comp1_idx]['MAG_AUTO']
-        comp2_mag = df.iloc[comp2_idx]['MAG_AUTO']
-        
-        # Skip if any magnitude is invalid
-        if not all(np.isfinite([ast_mag, ast_magerr, comp1_mag, comp2_mag])):
-            print(f"Warning: Invalid magnitude values in data_id {data_id}")
-            continue
+        row_epoch.append(np.full(valid.sum(), epoch))
+        row_idx.append(offset - len(df) + np.flatnonzero(valid))
+        xyz.append(_radec_to_unit_vectors(ra[valid], dec[valid]))
+    
+    if not xyz:
+        return None
+    
+    row_epoch = np.concatenate(row_epoch)
+    points = np.column_stack([np.concatenate(xyz), row_epoch * _EPOCH_SPACING])
+    return row_epoch, np.concatenate(row_idx), cKDTree(points)
+
+def _nearest(catalog: tuple, ra, dec, max_distance=5.0, epochs=0) -> tuple:
+    """Find the nearest objects of a prepared catalog to one or more positions.
+    
+    All positions, of all epochs, are looked up in a single KD-tree query.
+    
+    Args:
+        catalog: Result of _prepare_catalog
+        ra, dec: Query coordinates in degrees (scalars or sequences)
+        max_distance: Maximum separation in arcseconds (scalar or one per position)
+        epochs: Epoch of each position, i.e. its DataFrame's position in the
+            list passed to _prepare_catalog (scalar or one per position)
         
-        result = {
-            'MJD': mjd,
-            'AST_RA': ast_ra,
-            'AST_DEC': ast_dec,
-            'AST_SEP': ast_sep,
-            'AST_MAG': ast_mag,
-            'AST_MAGERR': ast_magerr,
-            'COMP1_MAG': comp1_mag,
-            'COMP2_MAG': comp2_mag
-        }
-        results.append(result)
+    Returns:
+        Tuple (rows, separations_arcsec) of arrays, with row -1 and NaN
+        separation where no object of the epoch lies within max_distance
+    """
+    ra = np.atleast_1d(ra)
+    dec = np.atleast_1d(dec)
+    if catalog is None:
+        return np.full(len(ra), -1), np.full(len(ra), np.nan)
+    row_epoch, row_idx, tree = catalog
+    epochs = np.broadcast_to(epochs, ra.shape)
+    
+    points = np.column_stack([_radec_to_unit_vectors(ra, dec), epochs * _EPOCH_SPACING])
+    chord, min_idx = tree.query(points)
+    min_sep = _chord_to_arcsec(chord)
+    # Epochs without valid coordinates return a neighbour from another epoch
+    found = (row_epoch[min_idx] == epochs) & (min_sep <= np.broadcast_to(max_distance, min_sep.shape))
+    
+    return np.where(found, row_idx[min_idx], -1), np.where(found, min_sep, np.nan)
+
+def _stack_columns(dfs: list) -> np.ndarray:
+    """Stack the _GATHER_COLUMNS of all epochs into one float array.
     
-    return pd.DataFrame(results)
+    A trailing row of NaN is appended, so row -1 (no match) gathers NaN.
+    """
+    return np.concatenate([df[_GATHER_COLUMNS].to_numpy(float) for df in dfs] +
+                          [np.full((1, len(_GATHER_COLUMNS)), np.nan)])
+
+def find_nearest_object(df: pd.DataFrame, ra: float, dec: float, max_distance: float = 5.0) -> tuple:
+    """Find the nearest object in DataFrame to given coordinates within max_distance arcseconds."""
+    rows, seps = _nearest(_prepare_catalog([df]), ra, dec, max_distance)
+    if rows[0] < 0:
+        return None, None
+    return rows[0], seps[0]
+
+def find_nearest_mjd_position(positions_df: pd.DataFrame, mjd) -> np.ndarray:
+    """Find asteroid positions at the nearest MJD for one or more epochs.
+    
+    Args:
+        positions_df: Asteroid positions, sorted by MJD
+        mjd: Epoch MJD (scalar or sequence)
+        
+    Returns:
+        Array of shape (N, 2) with RA and DEC of each epoch
+    """
+    mjd_arr = positions_df['MJD'].to_numpy()
+    mjd = np.atleast_1d(mjd)
+    
+    # Binary search the sorted times, then take the closer neighbour
+    # (the earlier one on ties, as argmin would)
+    right = np.clip(np.searchsorted(mjd_arr, mjd), 1, len(mjd_arr) - 1)
+    left = right - 1
+    idx = np.where(mjd - mjd_arr[left] <= mjd_arr[right] - mjd, left, right)
+    return positions_df[['RA', 'DEC']].to_numpy()[idx]
+
+def process_asteroid_photometry(photometry_data: dict, positions_df: pd.DataFrame, objects: dict) -> pd.DataFrame:
+    """Process photometry data using comparison stars."""
+    # Sort positions by MJD once; the range then comes from the ends
+    positions_df = positions_df.sort_values('MJD', kind='mergesort').reset_index(drop=True)
+    mjd_arr = positions_df['MJD'].to_numpy()
+    mjd_min, mjd_max = mjd_arr[0], mjd_arr[-1]
+    
+    # Match comparison stars and asteroid of all epochs inside the position range
+    # in one query, the asteroid with a larger search radius (JPL positions can
+    # be off by ~15")
+    items = list(photometry_data.items())
+    in_range = [i for i, (_, data) in enumerate(items) if mjd_min <= data['mjd'] <= mjd_max]
+    ast_positions = find_nearest_mjd_position(positions_df, [items[i][1]['mjd'] for i in in_range])
+    n_epochs = len(in_range)
+    dfs = [items[i][1]['df'] for i in in_range]
+    rows, seps = _nearest(
+        _prepare_catalog(dfs),
+        np.column_stack([np.full(n_epochs, objects['comp1']['ra']),
+                         np.full(n_epochs, objects['comp2']['ra']),
+                         ast_positions[:, 0]]).ravel(),
+        np.column_stack([np.full(n_epochs, objects['comp1']['dec']),
+                         np.full(n_epochs, objects['comp2']['dec']),
+                         ast_positions[:, 1]]).ravel(),
+        max_distance=np.tile([5.0, 5.0, 20.0], n_epochs),
+        epochs=np.repeat(np.arange(n_epochs), 3)
+    )
+    rows = rows.reshape(n_epochs, 3)
+    seps = seps.reshape(n_epochs, 3)
+    epoch_of = {i: k for k, i in enumerate(in_range)}
+    
+    # Gather comp1, comp2 and asteroid magnitudes of all epochs in one take
+    mags = _stack_columns(dfs)[rows, :2]
+    comp1_mag, comp2_mag = mags[:, 0, 0], mags[:, 1, 0]
+    ast_mag, ast_magerr = mags[:, 2, 0], mags[:, 2, 1]
+    valid_mags = np.isfinite(np.column_stack([ast_mag, ast_magerr, comp1_mag, comp2_mag])).all(axis=1)
+    comp_found = (rows[:, :2] >= 0).all(axis=1)
+    ast_found = rows[:, 2] >= 0
+    keep = comp_found & ast_found & valid_mags
+    
+    # Per-epoch details, only walked when debug output is enabled (-v)
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, (data_id, data) in enumerate(items):
+            if i not in epoch_of:
+                logger.debug(f"Warning: MJD {data['mjd']} is outside asteroid position range ({mjd_min:.6f} to {mjd_max:.6f})")
+                continue
+            
+            k = epoch_of[i]
+            ast_ra, ast_dec = ast_positions[k]
+            logger.debug(f"\nLooking for stars in data_id {data_id}:")
+            logger.debug(f"Comp1 target: RA={objects['comp1']['ra']:.6f}°, Dec={objects['comp1']['dec']:.6f}°")
+            logger.debug(f"Comp2 target: RA={objects['comp2']['ra']:.6f}°, Dec={objects['comp2']['dec']:.6f}°")
+            logger.debug(f"First 3 objects in the data:\n{data['df'][['ALPHA_J2000', 'DELTA_J2000', 'MAG_AUTO']].head(3)}")
+            if rows[k, 0] >= 0:
+                logger.debug(f"Found Comp1 at separation {seps[k, 0]:.1f} arcsec")
+            if rows[k, 1] >= 0:
+                logger.debug(f"Found Comp2 at separation {seps[k, 1]:.1f} arcsec")
+            
+            if not comp_found[k]:
+                logger.debug(f"Warning: Could not find comparison stars in data_id {data_id}")
+            elif not ast_found[k]:
+                logger.debug(f"Warning: Could not find asteroid at RA={ast_ra:.6f}°, Dec={ast_dec:.6f}° in data_id {data_id}")
+            elif not valid_mags[k]:
+                logger.debug(f"Warning: Invalid magnitude values in data_id {data_id}")
+    
+    print(f"\nMatched {keep.sum()} of {len(items)} epochs: "
+          f"{len(items) - n_epochs} outside asteroid position range, "
+          f"{(~comp_found).sum()} without comparison stars, "
+          f"{(comp_found & ~ast_found).sum()} without asteroid, "
+          f"{(comp_found & ast_found & ~valid_mags).sum()} with invalid magnitudes")
+    
+    mjds = np.array([items[i][1]['mjd'] for i in in_range], dtype=float)
+    return pd.DataFrame({
+        'MJD': mjds[keep],
+        'AST_RA': ast_positions[keep, 0],
+        'AST_DEC': ast_positions[keep, 1],
+        'AST_SEP': seps[keep, 2],
+        'AST_MAG': ast_mag[keep],
+        'AST_MAGERR': ast_magerr[keep],
+        'COMP1_MAG': comp1_mag[keep],
+        'COMP2_MAG': comp2_mag[keep]
+    })
 
 def process_static_object_photometry(photometry_data: dict, target_coords: dict, comp_stars: dict) -> pd.DataFrame:
     """Process photometry data for a static object using comparison stars.
@@ -154,47 +252,54 @@ def process_static_object_photometry(photometry_data: dict, target_coords: dict,
     Returns:
         pd.DataFrame: Processed photometry results
     """
-    results = []
-    
-    for data_id, data in photometry_data.items():
-        mjd = data['mjd']
-        df = data['df']
-        
-        # Find target and comparison stars
-        print(f"\nLooking for stars in data_id {data_id}:")
-        target_idx, target_sep = find_nearest_object(df, target_coords['ra'], target_coords['dec'])
-        comp1_idx, comp1_sep = find_nearest_object(df, comp_stars['comp1']['ra'], comp_stars['comp1']['dec'])
-        comp2_idx, comp2_sep = find_nearest_object(df, comp_stars['comp2']['ra'], comp_stars['comp2']['dec'])
-        
-        # Check if all objects were found
-        if any(idx is None for idx in [target_idx, comp1_idx, comp2_idx]):
-            print(f"Warning: Could not find all objects in data_id {data_id}")
-            continue
+    # Find target and comparison stars of all epochs in one query
+    items = list(photometry_data.items())
+    n_epochs = len(items)
+    dfs = [data['df'] for _, data in items]
+    rows, seps = _nearest(
+        _prepare_catalog(dfs),
+        np.tile([target_coords['ra'], comp_stars['comp1']['ra'], comp_stars['comp2']['ra']], n_epochs),
+        np.tile([target_coords['dec'], comp_stars['comp1']['dec'], comp_stars['comp2']['dec']], n_epochs),
+        epochs=np.repeat(np.arange(n_epochs), 3)
+    )
+    rows = rows.reshape(n_epochs, 3)
+    found = (rows >= 0).all(axis=1)
+    target_sep = seps.reshape(n_epochs, 3)[:, 0]
+    
+    # Gather target, comp1 and comp2 values of all epochs in one take
+    matched = _stack_columns(dfs)[rows]
+    target_mag, target_magerr, target_ra, target_dec = matched[:, 0].T
+    comp1_mag, comp2_mag = matched[:, 1, 0], matched[:, 2, 0]
+    valid_mags = np.isfinite(np.column_stack([target_mag, target_magerr, comp1_mag, comp2_mag])).all(axis=1)
+    
+    keep = found & valid_mags
+    
+    # Per-epoch details, only walked when debug output is enabled (-v)
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, data_id in enumerate(photometry_data):
+            logger.debug(f"\nLooking for stars in data_id {data_id}:")
             
-        # Extract magnitudes and check for valid values
-        target_mag = df.iloc[target_idx]['MAG_AUTO']
-        target_magerr = df.iloc[target_idx]['MAGERR_AUTO']
-        comp1_mag = df.iloc[comp1_idx]['MAG_AUTO']
-        comp2_mag = df.iloc[comp2_idx]['MAG_AUTO']
-        
-        # Skip if any magnitude is invalid
-        if not all(np.isfinite([target_mag, target_magerr, comp1_mag, comp2_mag])):
-            print(f"Warning: Invalid magnitude values in data_id {data_id}")
-            continue
-        
-        result = {
-            'MJD': mjd,
-            'TARGET_RA': df.iloc[target_idx]['ALPHA_J2000'],
-            'TARGET_DEC': df.iloc[target_idx]['DELTA_J2000'],
-            'TARGET_SEP': target_sep,
-            'TARGET_MAG': target_mag,
-            'TARGET_MAGERR': target_magerr,
-            'COMP1_MAG': comp1_mag,
-            'COMP2_MAG': comp2_mag
-        }
-        results.append(result)
-    
-    return pd.DataFrame(results)
+            # Check if all objects were found and magnitudes are valid
+            if not found[i]:
+                logger.debug(f"Warning: Could not find all objects in data_id {data_id}")
+            elif not valid_mags[i]:
+                logger.debug(f"Warning: Invalid magnitude values in data_id {data_id}")
+    
+    print(f"\nMatched {keep.sum()} of {n_epochs} epochs: "
+          f"{(~found).sum()} without all objects, "
+          f"{(found & ~valid_mags).sum()} with invalid magnitudes")
+    
+    mjds = np.array([data['mjd'] for _, data in items], dtype=float)
+    return pd.DataFrame({
+        'MJD': mjds[keep],
+        'TARGET_RA': target_ra[keep],
+        'TARGET_DEC': target_dec[keep],
+        'TARGET_SEP': target_sep[keep],
+        'TARGET_MAG': target_mag[keep],
+        'TARGET_MAGERR': target_magerr[keep],
+        'COMP1_MAG': comp1_mag[keep],
+        'COMP2_MAG': comp2_mag[keep]
+    })
 
 def plot_magnitude_ratios(results: pd.DataFrame, save_path: str = 'magnitude_ratios.png', 
                           ylim_sigma_factor: float = 3.0):
@@ -206,27 +311,33 @@ def plot_magnitude_ratios(results: pd.DataFrame, save_path: str = 'magnitude_rat
         save_path: Path to save the plot
         ylim_sigma_factor: Y-axis limit factor (median ± factor * std), default: 3.0
     """
-    # Calculate magnitude differences
-    results['TARGET_COMP1'] = results['TARGET_MAG'] - results['COMP1_MAG']
-    results['TARGET_COMP2'] = results['TARGET_MAG'] - results['COMP2_MAG']
-    results['COMP1_COMP2'] = results['COMP1_MAG'] - results['COMP2_MAG']
+    # Calculate magnitude differences on plain arrays, leaving results untouched
+    target_mag = results['TARGET_MAG'].to_numpy()
+    target_magerr = results['TARGET_MAGERR'].to_numpy()
+    comp1_mag = results['COMP1_MAG'].to_numpy()
+    comp2_mag = results['COMP2_MAG'].to_numpy()
+    target_comp1 = target_mag - comp1_mag
+    target_comp2 = target_mag - comp2_mag
+    comp1_comp2 = comp1_mag - comp2_mag
     
     # Calculate relative time in hours from first observation
-    time_offset = results['MJD'].min()
-    results['TIME_HOURS'] = (results['MJD'] - time_offset) * 24
+    mjd = results['MJD'].to_numpy()
+    time_offset = mjd.min()
+    time_hours = (mjd - time_offset) * 24
 
     # Create figure with 3 subplots
-    fig, axes = plt.subplots(3, 1, figsize=(14, 10), sharex=True)
+    fig, axes = plt.subplots(3, 1, figsize=(14, 10), sharex=True, constrained_layout=True)
     fig.suptitle(f'Differential Photometry\nMJD {time_offset:.5f} + hours', 
                  fontsize=14, fontweight='bold')
 
     # Plot 1: Target - Comp1 (main light curve)
     ax1 = axes[0]
-    ax1.errorbar(results['TIME_HOURS'], results['TARGET_COMP1'], 
-                yerr=results['TARGET_MAGERR'], 
-                fmt='o', markersize=4, color='blue', capsize=2, alpha=0.7)
-    median1 = results['TARGET_COMP1'].median()
-    std1 = results['TARGET_COMP1'].std()
+    # Error bars as one vlines collection plus one scatter, instead of per-point errorbar artists
+    ax1.vlines(time_hours, target_comp1 - target_magerr, target_comp1 + target_magerr,
+               colors='blue', alpha=0.7, linewidth=1)
+    ax1.scatter(time_hours, target_comp1, s=16, color='blue', alpha=0.7)
+    median1 = np.median(target_comp1)
+    std1 = target_comp1.std(ddof=1)
     ax1.axhline(median1, color='red', linestyle='--', alpha=0.5, label=f'Median: {median1:.4f}')
     ylim_range1 = ylim_sigma_factor * std1
     ax1.set_ylim(median1 + ylim_range1, median1 - ylim_range1)  # Inverted, ±(factor*σ) mag range
@@ -239,11 +350,11 @@ def plot_magnitude_ratios(results: pd.DataFrame, save_path: str = 'magnitude_rat
 
     # Plot 2: Target - Comp2 (verification light curve)
     ax2 = axes[1]
-    ax2.errorbar(results['TIME_HOURS'], results['TARGET_COMP2'], 
-                yerr=results['TARGET_MAGERR'], 
-                fmt='o', markersize=4, color='red', capsize=2, alpha=0.7)
-    median2 = results['TARGET_COMP2'].median()
-    std2 = results['TARGET_COMP2'].std()
+    ax2.vlines(time_hours, target_comp2 - target_magerr, target_comp2 + target_magerr,
+               colors='red', alpha=0.7, linewidth=1)
+    ax2.scatter(time_hours, target_comp2, s=16, color='red', alpha=0.7)
+    median2 = np.median(target_comp2)
+    std2 = target_comp2.std(ddof=1)
     ax2.axhline(median2, color='blue', linestyle='--', alpha=0.5, label=f'Median: {median2:.4f}')
     ylim_range2 = ylim_sigma_factor * std2
     ax2.set_ylim(median2 + ylim_range2, median2 - ylim_range2)  # Inverted, ±(factor*σ) mag range
@@ -256,12 +367,12 @@ def plot_magnitude_ratios(results: pd.DataFrame, save_path: str = 'magnitude_rat
 
     # Plot 3: Comp1 - Comp2 (check star stability)
     ax3 = axes[2]
-    comp_err = np.sqrt(2) * results['TARGET_MAGERR'].median()  # Approximate error
-    ax3.errorbar(results['TIME_HOURS'], results['COMP1_COMP2'], 
-                yerr=comp_err,
-                fmt='o', markersize=4, color='green', capsize=2, alpha=0.7)
-    median3 = results['COMP1_COMP2'].median()
-    std3 = results['COMP1_COMP2'].std()
+    comp_err = np.sqrt(2) * np.median(target_magerr)  # Approximate error
+    ax3.vlines(time_hours, comp1_comp2 - comp_err, comp1_comp2 + comp_err,
+               colors='green', alpha=0.7, linewidth=1)
+    ax3.scatter(time_hours, comp1_comp2, s=16, color='green', alpha=0.7)
+    median3 = np.median(comp1_comp2)
+    std3 = comp1_comp2.std(ddof=1)
     ax3.axhline(median3, color='purple', linestyle='--', alpha=0.5, label=f'Median: {median3:.4f}')
     ylim_range3 = ylim_sigma_factor * std3
     ax3.set_ylim(median3 + ylim_range3, median3 - ylim_range3)  # Inverted, ±(factor*σ) mag range
@@ -274,8 +385,8 @@ def plot_magnitude_ratios(results: pd.DataFrame, save_path: str = 'magnitude_rat
              bbox=dict(facecolor='white', alpha=0.8), va='top', fontsize=10)
 
     # Save plot
-    plt.tight_layout()
-    plt.savefig(save_path, dpi=150)
+    fig.savefig(save_path, dpi=150)
+    plt.close(fig)
     print(f"\nPlot saved to {save_path}")
 
 def filter_photometry_data(photometry_data: dict, filter_name: str = None) -> dict:
@@ -317,10 +428,69 @@ def filter_photometry_data(photometry_data: dict, filter_name: str = None) -> di
     
     return filtered_data
 
-def main():
-    """Main function to process photometry data."""
-    import os
+def load_photometry_metadata(data_file: str) -> dict:
+    """Load per-epoch metadata saved by get_data_bhtom.py.
     
+    Args:
+        data_file: Parquet table (with a .json metadata file next to it),
+                   or a legacy .pkl file
+        
+    Returns:
+        Dictionary mapping data IDs to {'mjd', 'calibration_data'}. A legacy
+        .pkl file is loaded whole, so its entries also carry 'df'
+    """
+    if data_file.endswith('.pkl'):
+        with open(data_file, 'rb') as f:
+            return pickle.load(f)
+    
+    with open(os.path.splitext(data_file)[0] + '.json') as f:
+        metadata = json.load(f)
+    return {entry['data_id']: {'mjd': entry['mjd'], 'calibration_data': entry['calibration_data']}
+            for entry in metadata}
+
+def load_photometry_data(data_file: str, epochs: dict = None) -> dict:
+    """Load photometry data saved by get_data_bhtom.py.
+    
+    Only the detections of the requested epochs are read from the Parquet
+    table, with the data_id selection pushed down to the reader.
+    
+    Args:
+        data_file: Parquet table (with a .json metadata file next to it),
+                   or a legacy .pkl file
+        epochs: Epochs to load, as returned by load_photometry_metadata
+                (possibly filtered). If None, all epochs are loaded.
+        
+    Returns:
+        Dictionary mapping data IDs to {'df', 'mjd', 'calibration_data'}
+    """
+    if epochs is None:
+        epochs = load_photometry_metadata(data_file)
+    if data_file.endswith('.pkl') or not epochs:
+        return epochs  # Legacy pickle entries already carry their detections
+    
+    table = pd.read_parquet(data_file, filters=[('data_id', 'in', list(epochs))])
+    
+    groups = dict(iter(table.groupby('data_id', sort=False)))
+    empty = table.iloc[:0]  # Epochs without detections have no rows in the table
+    photometry_data = {}
+    for data_id, entry in epochs.items():
+        df = groups.get(data_id, empty).drop(columns=['data_id', 'mjd']).reset_index(drop=True)
+        photometry_data[data_id] = {
+            'df': df,
+            'mjd': entry['mjd'],
+            'calibration_data': entry['calibration_data']
+        }
+    return photometry_data
+
+def main(argv: list = None) -> int:
+    """Main function to process photometry data.
+    
+    Args:
+        argv: Command line arguments (defaults to sys.argv[1:])
+        
+    Returns:
+        Exit code: 0 on success, 1 if no data or no valid measurements
+    """
     # Parse command line arguments
     parser = argparse.ArgumentParser(
         description='Process differential photometry from BHTOM data',
@@ -347,8 +517,15 @@ Note: Use exact BHTOM filter names (e.g., GaiaSP/R, not just R)
         default=3.0,
         help='Y-axis limit factor: median ± (factor * std). Default: 3.0'
     )
+    parser.add_argument(
+        '--verbose', '-v',
+        action='store_true',
+        help='Print per-epoch cross-matching details'
+    )
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(message)s')
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
     
     # Configuration parameters
     YLIM_SIGMA_FACTOR = args.ylim_sigma  # Y-axis limit factor: median ± (factor * std)
@@ -366,26 +543,26 @@ Note: Use exact BHTOM filter names (e.g., GaiaSP/R, not just R)
     print()
     
     # Read photometry data
-    data_file = 'data/photometry_data.pkl'
+    data_file = 'data/photometry_data.parquet'
+    if not os.path.exists(data_file):
+        data_file = 'data/photometry_data.pkl'  # Fallback to old pickle output
     if not os.path.exists(data_file):
         data_file = 'photometry_data.pkl'  # Fallback to old location
     
-    with open(data_file, 'rb') as f:
-        import pickle
-        photometry_data = pickle.load(f)
+    # Read metadata first, detections are loaded only for the selected epochs
+    photometry_data = load_photometry_metadata(data_file)
     print(f"Read photometry data for {len(photometry_data)} epochs (all filters)")
     
     # Filter by band if specified
     if args.filter:
         print(f"\nFiltering data for filter: {args.filter}")
+        all_data = photometry_data  # Kept to list available filters on a miss
         photometry_data = filter_photometry_data(photometry_data, args.filter)
         print(f"After filtering: {len(photometry_data)} epochs in {args.filter} band")
         
         if len(photometry_data) == 0:
             print(f"\nERROR: No data found for filter '{args.filter}'")
             print("\nAvailable filters in the data:")
-            with open(data_file, 'rb') as f:
-                all_data = pickle.load(f)
             filters = set()
             for data_dict in all_data.values():
                 calibration = data_dict.get('calibration_data', {})
@@ -393,10 +570,12 @@ Note: Use exact BHTOM filter names (e.g., GaiaSP/R, not just R)
                 filters.add(band)
             for f in sorted(filters):
                 print(f"  • {f}")
-            return
+            return 1
     else:
         print("\nProcessing all filters (no filter specified)")
     
+    photometry_data = load_photometry_data(data_file, photometry_data)
+    
     # Prepare coordinates for static object photometry
     target_coords = {'ra': float(objects['target'].split(',')[1]), 'dec': float(objects['target'].split(',')[2])}
     comp_stars = {
@@ -414,7 +593,7 @@ Note: Use exact BHTOM filter names (e.g., GaiaSP/R, not just R)
     
     if len(results) == 0:
         print("\nNo valid measurements found!")
-        return
+        return 1
         
     print(f"\nProcessed {len(results)} measurements")
     
@@ -439,6 +618,8 @@ Note: Use exact BHTOM filter names (e.g., GaiaSP/R, not just R)
         for col in mag_cols[1:]:
             mags[col] = mags[col].map(lambda x: f"{x:7.4f}")
         print(mags.to_string())
+    
+    return 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())